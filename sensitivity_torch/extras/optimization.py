@@ -1,5 +1,5 @@
 ##^# library imports and utils #################################################
-import math, os, pdb, sys, time
+import math, os, pdb, sys, time, inspect
 from typing import Callable
 
 import torch, numpy as np
@@ -8,6 +8,85 @@ from tqdm import tqdm
 
 from ..utils import TablePrinter
 
+
+def _fused_adam_devices():
+    """Device types with fused optimizer kernels in the installed torch."""
+    try:
+        from torch.utils._foreach_utils import (
+            _get_fused_kernels_supported_devices,
+        )
+    except ImportError:
+        return ["cuda"]
+    return _get_fused_kernels_supported_devices()
+
+
+def _make_adam(args, lr, tensor_lr=False):
+    """Construct Adam using the fused kernel if possible, else multi-tensor.
+    A ``tensor_lr`` (fused only) avoids recompilation under ``torch.compile``.
+    """
+    params = inspect.signature(torch.optim.Adam).parameters
+    devices = set(arg.device for arg in args)
+    if (
+        "fused" in params
+        and len(devices) == 1
+        and all(torch.is_floating_point(arg) for arg in args)
+    ):
+        device = next(iter(devices))
+        if device.type in _fused_adam_devices():
+            lr = torch.tensor(lr) if tensor_lr else lr
+            return torch.optim.Adam(args, lr=lr, fused=True)
+    if "foreach" in params:
+        return torch.optim.Adam(args, lr=lr, foreach=True)
+    return torch.optim.Adam(args, lr=lr)
+
+
+def _assign_grads(args, gs):
+    """Copy gradients ``gs`` into primed ``arg.grad`` buffers (multi-tensor)."""
+    torch._foreach_copy_([arg.grad for arg in args], [g.detach() for g in gs])
+
+
+@torch.no_grad()
+def _improvement(args, args_prev, batched=False):
+    """Sum of per-argument step norms (batch-averaged if ``batched``)."""
+    diffs = torch._foreach_sub(list(args_prev), list(args))
+    if batched:
+        # _foreach_norm has no dim= argument (nor a vmap rule), reduce per arg
+        norms = [
+            torch.mean(
+                torch.linalg.vector_norm(
+                    diff, dim=tuple(range(-(diff.ndim - 1), 0))
+                )
+            )
+            for diff in diffs
+        ]
+    else:
+        norms = torch._foreach_norm(diffs)
+    return torch.stack(norms).sum()
+
+
+def _alloc_hist(args, n):
+    """Preallocate a stacked history of ``n`` iterates, starting at ``args``."""
+    hist = [
+        torch.empty((n,) + arg.shape, dtype=arg.dtype, device=arg.device)
+        for arg in args
+    ]
+    torch._foreach_copy_([h[0] for h in hist], [arg.detach() for arg in args])
+    return hist
+
+
+def _to_host(*vals):
+    """Copy a group of scalar tensors to the host with a single sync."""
+    vals = [val.detach().reshape(()) for val in vals]
+    return torch.stack([val.to(vals[0].dtype) for val in vals]).cpu().tolist()
+
+
+@torch.no_grad()
+def _grad_norm(args):
+    """Sum of per-argument gradient norms."""
+    grads = [arg.grad for arg in args if arg.grad is not None]
+    return torch.stack(torch._foreach_norm(grads)).sum()
+
+
 ##$#############################################################################
 ##^# Accelerated Gradient Descent ##############################################
 def minimize_agd(
@@ -24,6 +103,7 @@ def minimize_agd(
     callback_fn: Callable = None,
     use_writer: bool = False,
     use_tqdm: bool = True,
+    compile: bool = False,
 ):
     """Minimize a loss function ``f_fn`` with Accelerated Gradient Descent (AGD)
     with respect to ``*args``. Uses PyTorch.
@@ -42,26 +122,38 @@ def minimize_agd(
         callback_fn: callback function of the form ``cb_fn(*args, **kw)``
         use_writer: whether to use tensorflow's Summary Writer (via PyTorch)
         use_tqdm: whether to use tqdm (to estimate total runtime)
+        compile: whether to ``torch.compile`` the step, only used on CUDA with
+                 fused Adam and max_it >= 50 (recompiles on every call)
     Returns:
-        Optimized ``args`` or ``(args, args_hist)`` if ``full_output`` is ``True``
+        Optimized (C-contiguous) ``args`` or ``(args, args_hist)`` if
+        ``full_output`` is ``True``, ``args_hist`` is a ``(it_nb, *arg.shape)``
+        tensor of iterates per ``arg`` (a list of those for multiple ``args``)
     """
     assert len(args) > 0
     assert g_fn is not None or all(
         [isinstance(arg, torch.Tensor) for arg in args]
     )
-    args = [arg.clone().detach() for arg in args]
+    args = [
+        arg.detach().clone(memory_format=torch.contiguous_format)
+        for arg in args
+    ]
     for arg in args:
         arg.requires_grad = True
-    imprv = float("inf")
     gam = (af / ai) ** (1.0 / max_it)
-    opt = torch.optim.Adam(args, lr=ai)
+    # compiling only pays off with CUDA graphs, and needs fused Adam's tensor lr
+    # so that the lr decay does not trigger a recompilation every step
+    compile = compile and max_it >= 50 and all(arg.is_cuda for arg in args)
+    opt = _make_adam(args, ai, tensor_lr=compile)
+    compile = compile and bool(opt.defaults.get("fused", False))
+    sched = torch.optim.lr_scheduler.ExponentialLR(opt, gamma=gam)
     tp = TablePrinter(
         ["it", "imprv", "loss", "||g||_2"],
         ["%05d", "%9.4e", "%9.4e", "%9.4e"],
         prefix=verbose_prefix,
         use_writer=use_writer,
     )
-    args_hist = [[arg.detach().clone() for arg in args]]
+    args_hist = _alloc_hist(args, max_it + 1) if full_output else None
+    args_prev = [torch.empty_like(arg) for arg in args]
 
     if callback_fn is not None:
         callback_fn(*args)
@@ -69,11 +161,16 @@ def minimize_agd(
     print_fn = print if not use_tqdm else tqdm.write
     if verbose:
         print_fn(tp.make_header())
-    it_rng = range(max_it) if not use_tqdm else tqdm(range(max_it))
-    for it in it_rng:
-        args_prev = [arg.clone().detach() for arg in args]
-        opt.zero_grad()
+
+    if g_fn is not None:
+        for arg in args:
+            arg.grad = torch.zeros_like(arg)
+
+    def _step():
+        if verbose:
+            torch._foreach_copy_(args_prev, [arg.detach() for arg in args])
         if g_fn is None:
+            opt.zero_grad()
             l = torch.sum(f_fn(*args))
             l.backward()
             if batched:
@@ -83,41 +180,36 @@ def minimize_agd(
             l = torch.mean(f_fn(*args_))
             gs = g_fn(*args_)
             gs = gs if isinstance(gs, list) or isinstance(gs, tuple) else [gs]
-            for (arg, g) in zip(args, gs):
-                arg.grad = torch.detach(g)
-        g_norm = sum(
-            torch.norm(arg.grad) for arg in args if arg.grad is not None
-        ).detach() / len(args)
+            _assign_grads(args, gs)
         opt.step()
-        args_hist.append([arg.detach().clone() for arg in args])
+        if not verbose:  # statistics are only needed for printing
+            return None
+        g_norm = _grad_norm(args) / len(args)
+        imprv = _improvement(args, args_prev, batched=batched)
+        return imprv, l.detach(), g_norm
+
+    step_fn = _step
+    if compile:
+        step_fn = torch.compile(_step, fullgraph=False, mode="reduce-overhead")
+
+    it_rng = range(max_it) if not use_tqdm else tqdm(range(max_it))
+    for it in it_rng:
+        stats = step_fn()
+        sched.step()
+        if full_output:
+            torch._foreach_copy_(
+                [h[it + 1] for h in args_hist], [arg.detach() for arg in args]
+            )
         if callback_fn is not None:
             callback_fn(*args)
-        if batched:
-            imprv = sum(
-                torch.mean(
-                    torch.norm(
-                        arg_prev - arg, dim=tuple(range(-(arg.ndim - 1), 0))
-                    )
-                )
-                for (arg, arg_prev) in zip(args, args_prev)
-            )
-        else:
-            imprv = sum(
-                torch.norm(arg_prev - arg)
-                for (arg, arg_prev) in zip(args, args_prev)
-            )
         if verbose:
-            print_fn(tp.make_values([it, imprv.detach(), l.detach(), g_norm]))
-        for pgroup in opt.param_groups:
-            pgroup["lr"] *= gam
-        it += 1
+            print_fn(tp.make_values([it] + _to_host(*stats)))
     if verbose:
         print_fn(tp.make_footer())
     ret = [arg.detach() for arg in args]
     ret = ret if len(args) > 1 else ret[0]
-    args_hist = [z if len(args) > 1 else z[0] for z in args_hist]
     if full_output:
-        return ret, args_hist
+        return ret, args_hist if len(args) > 1 else args_hist[0]
     else:
         return ret
 
@@ -155,26 +247,38 @@ def minimize_lbfgs(
         use_writer: whether to use tensorflow's Summary Writer (via PyTorch)
         use_tqdm: whether to use tqdm (to estimate total runtime)
     Returns:
-        Optimized ``args`` or ``(args, args_hist)`` if ``full_output`` is ``True``
+        Optimized (C-contiguous) ``args`` or ``(args, args_hist)`` if
+        ``full_output`` is ``True``, ``args_hist`` is a ``(it_nb, *arg.shape)``
+        tensor of iterates per ``arg`` (a list of those for multiple ``args``)
     """
     assert len(args) > 0
     assert g_fn is not None or all(
         [isinstance(arg, torch.Tensor) for arg in args]
     )
-    args = [arg.detach().clone() for arg in args]
+    args = [
+        arg.detach().clone(memory_format=torch.contiguous_format)
+        for arg in args
+    ]
     for arg in args:
         arg.requires_grad = True
     imprv = float("inf")
     it = 0
     opt = torch.optim.LBFGS(args, lr=lr)
-    args_hist = [[arg.detach().clone() for arg in args]]
+    args_hist = _alloc_hist(args, max_it + 1) if full_output else None
+    hist_len = 1
+    args_prev = [torch.empty_like(arg) for arg in args]
 
     if callback_fn is not None:
         callback_fn(*args)
 
+    if g_fn is not None:
+        for arg in args:
+            arg.grad = torch.zeros_like(arg)
+    state = dict()  # last closure evaluation, reused for verbose output
+
     def closure():
-        opt.zero_grad()
         if g_fn is None:
+            opt.zero_grad()
             l = torch.sum(f_fn(*args))
             l.backward()
             if batched:
@@ -184,8 +288,10 @@ def minimize_lbfgs(
             l = torch.mean(f_fn(*args_))
             gs = g_fn(*args_)
             gs = gs if isinstance(gs, list) or isinstance(gs, tuple) else [gs]
-            for (arg, g) in zip(args, gs):
-                arg.grad = torch.detach(g)
+            _assign_grads(args, gs)
+        if verbose:
+            state["l"], state["g_norm"] = l.detach(), _grad_norm(args)
+            state["versions"] = [arg._version for arg in args]
         return l
 
     tp = TablePrinter(
@@ -199,32 +305,22 @@ def minimize_lbfgs(
         print_fn(tp.make_header())
     it_rng = range(max_it) if not use_tqdm else tqdm(range(max_it))
     for it in it_rng:
-        args_prev = [arg.detach().clone() for arg in args]
+        torch._foreach_copy_(args_prev, [arg.detach() for arg in args])
         l = opt.step(closure)
         if full_output:
-            args_hist.append([arg.detach().clone() for arg in args])
+            torch._foreach_copy_(
+                [h[hist_len] for h in args_hist], [arg.detach() for arg in args]
+            )
+            hist_len += 1
         if callback_fn is not None:
             callback_fn(*args)
-        if batched:
-            imprv = sum(
-                torch.mean(
-                    torch.norm(
-                        arg_prev - arg, dim=tuple(range(-(arg.ndim - 1), 0))
-                    )
-                )
-                for (arg, arg_prev) in zip(args, args_prev)
-            )
-        else:
-            imprv = sum(
-                torch.norm(arg_prev - arg).detach()
-                for (arg, arg_prev) in zip(args, args_prev)
-            )
+        imprv = _improvement(args, args_prev, batched=batched)
         if verbose:
-            closure()
-            g_norm = sum(
-                arg.grad.norm().detach() for arg in args if arg.grad is not None
-            )
-            print_fn(tp.make_values([it, imprv.detach(), l.detach(), g_norm]))
+            # LBFGS skips the closure after its last inner step at max_iter
+            if state["versions"] != [arg._version for arg in args]:
+                closure()
+            stats = _to_host(imprv, state["l"], state["g_norm"])
+            print_fn(tp.make_values([it] + stats))
         if imprv < 1e-9:
             break
         it += 1
@@ -232,15 +328,27 @@ def minimize_lbfgs(
         print_fn(tp.make_footer())
     ret = [arg.detach() for arg in args]
     ret = ret if len(args) > 1 else ret[0]
-    args_hist = [z if len(args) > 1 else z[0] for z in args_hist]
     if full_output:
-        return ret, args_hist
+        if hist_len < max_it + 1:  # release the unused rows of the buffer
+            args_hist = [h[:hist_len].clone() for h in args_hist]
+        return ret, args_hist if len(args) > 1 else args_hist[0]
     else:
         return ret
 
 
 ##$#############################################################################
 ##^# SQP (own) #################################################################
+def _linesearch_constants(ls_pts_nb, device=None, dtype=None):
+    """Linesearch step lengths and zero step, invariant across iterations."""
+    opts = dict(device=device, dtype=dtype)
+    if ls_pts_nb >= 2:
+        bets = 10.0 ** torch.linspace(-1, 1, ls_pts_nb, **opts)
+    else:
+        bets = torch.ones((1,), **opts)
+    # bets = torch.linspace(1e-3, 2.0, ls_pts_nb)
+    return bets, torch.zeros((1,), **opts)
+
+
 def _linesearch(
     f,
     x,
@@ -250,48 +358,58 @@ def _linesearch(
     batched=False,
     ls_pts_nb=5,
     force_step=False,
+    batched_fn=False,
+    bets=None,
+    zero_prefix=None,
 ):
-    opts = dict(device=x.device, dtype=x.dtype)
-    if ls_pts_nb >= 2:
-        bets = 10.0 ** torch.linspace(-1, 1, ls_pts_nb, **opts)
+    if bets is None or zero_prefix is None:
+        bets, zero_prefix = _linesearch_constants(
+            ls_pts_nb, device=x.device, dtype=x.dtype
+        )
+    # if the current value is unknown, evaluate it alongside the other points
+    if f is None:
+        bets_eval = torch.cat([zero_prefix, bets], -1)
     else:
-        bets = torch.tensor([1.0], **opts)
-    # bets = torch.linspace(1e-3, 2.0, ls_pts_nb)
-    y = torch.stack(
-        [torch.atleast_1d(f_fn(x + bet * d)) for bet in bets],
-        1,
-    )
-    y = torch.where(torch.isnan(y), torch.tensor(math.inf, **opts), y)
+        bets_eval = bets
+    if batched_fn:  # evaluate all linesearch points in a single call
+        Xs = x[None, ...] + bets_eval.reshape((-1,) + (1,) * x.ndim) * d
+        y = f_fn(Xs).reshape((bets_eval.numel(), -1)).movedim(0, 1)
+    else:
+        y = torch.stack(
+            [torch.atleast_1d(f_fn(x + bet * d)) for bet in bets_eval], 1
+        )
+    y = torch.nan_to_num(y, nan=math.inf, posinf=math.inf, neginf=-math.inf)
+    if f is None:
+        f, y = y[:, 0], y[:, 1:]
 
     if not force_step:
-        bets = torch.cat([torch.zeros((1,), **opts), bets], -1)
+        bets = torch.cat([zero_prefix, bets], -1)
         y = torch.cat([torch.atleast_1d(f)[..., None], y], -1)
 
     idxs = torch.argmin(y, 1)
-    f_best = torch.tensor([y[i, idx] for (i, idx) in enumerate(idxs)], **opts)
-    bet = torch.tensor([bets[idx] for idx in idxs], **opts)
+    f_best = torch.gather(y, 1, idxs[:, None])[:, 0]
+    bet = bets[idxs]
 
     d_norm = torch.norm(d, dim=tuple(range(-(d.ndim - 1), 0)))
 
-    return bet, dict(d_norm=d_norm, f_best=f_best)
+    return bet, dict(d_norm=d_norm, f_best=f_best, f=f)
 
 
 def _positive_factorization_cholesky(H, reg0):
     reg_it_max = 0
-    reg, reg_it = reg0, 0
-    H_reg, F = None, None
+    reg, reg_it, reg_prev = reg0, 0, 0.0
+    H_reg, F = torch.clone(H), None
+    diag = H_reg.diagonal(dim1=-2, dim2=-1)
     while True:
-        try:
-            H_reg = torch.clone(H)
-            H_reg.diagonal(dim1=-2, dim2=-1)[:] += reg
-            F = torch.linalg.cholesky(H_reg)
-            assert not torch.any(torch.isnan(F))
+        diag.add_(reg - reg_prev)  # shift the diagonal in place
+        reg_prev = reg
+        F, info = torch.linalg.cholesky_ex(H_reg)
+        if int(torch.max(info)) == 0:
             break
-        except Exception as e:
-            reg_it += 1
-            reg *= 5e0
-            if reg >= 0.99e7:
-                raise RuntimeError("Numerical problems")
+        reg_it += 1
+        reg *= 5e0
+        if reg >= 0.99e7:
+            raise RuntimeError("Numerical problems")
     reg_it_max = max(reg_it_max, reg_it)
     return F, (reg_it, reg)
 
@@ -299,12 +417,11 @@ def _positive_factorization_cholesky(H, reg0):
 def _positive_factorization_lobpcg(H, reg0):
     H = H.detach()
     if H.shape[-1] < 3:
-        reg = torch.min(
-            torch.linalg.eigvals(H.reshape((H.shape[-1], H.shape[-1]))).real
-        )
+        reg = torch.linalg.eigvalsh(H)[..., 0]  # eigenvalues are ascending
     else:
-        reg = torch.lobpcg(H, k=1, largest=False, niter=100, tol=1e-3)[0]
-    reg = reg.reshape(-1)[0]
+        # the estimate is only a regularization heuristic, low accuracy is ok
+        reg = torch.lobpcg(H, k=1, largest=False, niter=50, tol=1e-2)[0]
+    reg = reg.reshape(-1)[0].item()
     return _positive_factorization_cholesky(H, max(max(-2.0 * reg, 0.0), reg0))
 
 
@@ -320,6 +437,7 @@ def minimize_sqp(
     ls_pts_nb: int = 5,
     force_step: bool = False,
     batched: bool = False,
+    batched_fn: bool = False,
     full_output: bool = False,
     callback_fn: Callable = None,
     use_writer: bool = False,
@@ -340,6 +458,7 @@ def minimize_sqp(
         batched: whether to optimize a batch of arguments, with batch of losses
         ls_pts_nb: number of linesearch points to consider per optimization step
         force_step: whether to take any non-zero optimization step even if worse
+        batched_fn: whether ``f_fn`` accepts a leading batch of linesearch points
         full_output: whether to output optimization history
         callback_fn: callback function of the form ``cb_fn(*args, **kw)``
         use_writer: whether to use tensorflow's Summary Writer (via PyTorch)
@@ -353,14 +472,18 @@ def minimize_sqp(
     x_shape = x.shape
     if batched:
         M, x_size = x_shape[0], np.prod(x_shape[1:])
-    else:
+        g_shape, H_shape = (M, x_size), (M, x_size, x_size)
+    else:  # avoid the batched linear algebra overhead for a single problem
         M, x_size = 1, x.numel()
+        g_shape, H_shape = (x_size,), (x_size, x_size)
     it, imprv = 0, float("inf")
-    x_best, f_best = x, torch.atleast_1d(f_fn(x))
-    f_hist, x_hist = [f_best], [x.detach().clone()]
+    x_best, f_best = x, None  # f_best is computed in the first linesearch
+    bets, zero_prefix = _linesearch_constants(
+        ls_pts_nb, device=x.device, dtype=x.dtype
+    )
+    f_hist, x_hist = [], [x.detach().clone()]
 
     if callback_fn is not None:
-        pdb.set_trace()
         callback_fn(x)
 
     tp = TablePrinter(
@@ -374,8 +497,8 @@ def minimize_sqp(
         print_fn(tp.make_header())
     it_rng = range(max_it) if not use_tqdm else tqdm(range(max_it))
     for it in it_rng:
-        g = g_fn(x).reshape((M, x_size))
-        H = h_fn(x).reshape((M, x_size, x_size))
+        g = g_fn(x).reshape(g_shape)
+        H = h_fn(x).reshape(H_shape)
         if torch.any(torch.isnan(g)):
             raise RuntimeError("Gradient is NaN")
         if torch.any(torch.isnan(H)):
@@ -384,10 +507,12 @@ def minimize_sqp(
         # F, (reg_it_max, _) = _positive_factorization_cholesky(H, reg0)
         F, (reg_it_max, _) = _positive_factorization_lobpcg(H, reg0)
 
-        d = torch.cholesky_solve(-g[..., None], F)[..., 0].reshape(x_shape)
+        y = torch.linalg.solve_triangular(F, -g[..., None], upper=False)
+        d = torch.linalg.solve_triangular(F.mT, y, upper=True)
+        d = d[..., 0].reshape(x_shape)
         # F = H + reg0 * I
         # d = torch.solve(F, -g[..., None])[..., 0].reshape(x_shape)
-        f = f_hist[-1]
+        f = f_hist[-1] if len(f_hist) > 0 else None
         bet, data = _linesearch(
             f,
             x,
@@ -396,39 +521,28 @@ def minimize_sqp(
             g_fn,
             ls_pts_nb=ls_pts_nb,
             force_step=force_step,
+            batched_fn=batched_fn,
+            bets=bets,
+            zero_prefix=zero_prefix,
         )
 
         x = x + torch.reshape(bet, (M,) + (1,) * len(x_shape[1:])) * d
-        x_hist.append(x.clone().detach())
+        x_hist.append(x.detach().clone())
         imprv = torch.mean(bet * data["d_norm"]).detach()
         if callback_fn is not None:
             callback_fn(x)
-        if batched:
-            x_bests = [None for _ in range(M)]
-            f_bests = [None for _ in range(M)]
-            for i in range(M):
-                if data["f_best"][i] < f_best[i]:
-                    x_bests[i], f_bests[i] = x[i, ...], data["f_best"][i]
-                else:
-                    x_bests[i], f_bests[i] = x_best[i, ...], f_best[i]
-            x_best, f_best = torch.stack(x_bests), torch.stack(f_bests)
-        else:
-            if data["f_best"][0] < f_best[0]:
-                x_best, f_best = x, data["f_best"]
+        f_best = f_best if f_best is not None else data["f"]
+        mask = data["f_best"] < f_best
+        f_best = torch.where(mask, data["f_best"], f_best)
+        mask_x = mask.reshape((M,) + (1,) * len(x_shape[1:]))
+        x_best = torch.where(mask_x, x, x_best)
         f_hist.append(data["f_best"])
         if verbose:
-            print_fn(
-                tp.make_values(
-                    [
-                        it,
-                        imprv,
-                        torch.mean(data["f_best"]),
-                        reg_it_max,
-                        bet[0],
-                        torch.norm(g),
-                    ]
-                )
+            stats = _to_host(
+                imprv, torch.mean(data["f_best"]), bet[0], torch.norm(g)
             )
+            stats = stats[:2] + [reg_it_max] + stats[2:]
+            print_fn(tp.make_values([it] + stats))
         if imprv < 1e-9:
             break
         it += 1
@@ -1,5 +1,6 @@
 ################################################################################
-import unittest, pdb, time, os, sys
+import unittest, pdb, time, os, sys, math, io, contextlib
+from unittest import mock
 
 import torch
 
@@ -12,6 +13,11 @@ except ModuleNotFoundError:
 torch.set_default_dtype(torch.float64)
 
 from sensitivity_torch.differentiation import JACOBIAN
+from sensitivity_torch.extras.optimization import (
+    minimize_agd,
+    minimize_lbfgs,
+    minimize_sqp,
+)
 
 import objs
 
@@ -88,5 +94,119 @@ for (OPT, params, name) in zip(OPTs, param_list, names):
     fn = generate_test(OPT, *params, name=name)
     setattr(DpzTest, "test_%s" % fn.__name__, fn)
 
+
+class NonContiguousTest(unittest.TestCase):
+    def test_non_contiguous_args(self):
+        A = torch.randn((5, 3)).T  # non-contiguous view
+        f_fn = lambda A: torch.sum((A - 1.0) ** 2)
+        for minimize_fn in [minimize_agd, minimize_lbfgs]:
+            ret = minimize_fn(f_fn, None, A, max_it=10, use_tqdm=False)
+            self.assertTrue(ret.is_contiguous())
+            self.assertEqual(ret.shape, A.shape)
+
+
+class CompileTest(unittest.TestCase):
+    @unittest.skipUnless(torch.cuda.is_available(), "compile is CUDA only")
+    def test_compile(self):
+        A = torch.randn((3, 5), device="cuda")
+        f_fn = lambda A: torch.sum((A - 1.0) ** 2)
+        kw = dict(max_it=50, use_tqdm=False)
+        ret1 = minimize_agd(f_fn, None, A, **kw)
+        with mock.patch("torch.compile", wraps=torch.compile) as compile_fn:
+            ret2 = minimize_agd(f_fn, None, A, compile=True, **kw)
+        compile_fn.assert_called_once()
+        self.assertTrue(torch.norm(ret1 - ret2) < 1e-9)
+
+    def test_compile_ignored_on_cpu(self):
+        A = torch.randn((3, 5))
+        f_fn = lambda A: torch.sum((A - 1.0) ** 2)
+        kw = dict(max_it=50, use_tqdm=False)
+        ret1 = minimize_agd(f_fn, None, A, **kw)
+        with mock.patch("torch.compile") as compile_fn:
+            ret2 = minimize_agd(f_fn, None, A, compile=True, **kw)
+        compile_fn.assert_not_called()
+        self.assertTrue(torch.equal(ret1, ret2))
+
+
+class VerboseTest(unittest.TestCase):
+    def test_lbfgs_verbose_loss_at_iterate(self):
+        A = torch.randn((3, 5))
+        f_fn = lambda A: torch.sum((A - 1.0) ** 2) + torch.sum(A ** 4)
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf):
+            ret = minimize_lbfgs(
+                f_fn, None, A, max_it=1, lr=1e-1, verbose=True, use_tqdm=False
+            )
+        row = buf.getvalue().splitlines()[-2]
+        loss = float(row.split("|")[3])
+        self.assertTrue(abs(loss - float(f_fn(ret))) <= 1e-3 * abs(loss))
+
+
+class HistoryTest(unittest.TestCase):
+    def test_agd_history(self):
+        A = torch.randn((3, 5))
+        f_fn = lambda A: torch.sum((A - 1.0) ** 2)
+        ret, hist = minimize_agd(
+            f_fn, None, A, max_it=20, full_output=True, use_tqdm=False
+        )
+        self.assertEqual(hist.shape, (20 + 1,) + A.shape)
+        self.assertTrue(torch.equal(hist[0], A))
+        self.assertTrue(torch.equal(hist[-1], ret))
+
+    def test_lbfgs_history_early_stop(self):
+        A = torch.randn((3, 5))
+        f_fn = lambda A: torch.sum((A - 1.0) ** 2)
+        ret, hist = minimize_lbfgs(
+            f_fn, None, A, max_it=50, full_output=True, use_tqdm=False
+        )
+        self.assertTrue(hist.shape[0] < 50 + 1)
+        self.assertEqual(hist.untyped_storage().nbytes(), hist.nbytes)
+        self.assertEqual(hist.shape[1:], A.shape)
+        self.assertTrue(torch.equal(hist[0], A))
+        self.assertTrue(torch.equal(hist[-1], ret))
+
+    def test_multiple_args_history(self):
+        A, B = torch.randn((3, 5)), torch.randn(4)
+        f_fn = lambda A, B: torch.sum((A - 1.0) ** 2) + torch.sum(B ** 2)
+        for minimize_fn in [minimize_agd, minimize_lbfgs]:
+            rets, hists = minimize_fn(
+                f_fn, None, A, B, max_it=5, full_output=True, use_tqdm=False
+            )
+            self.assertTrue(isinstance(hists, list))
+            self.assertEqual(len(hists), 2)
+            for (arg, ret, hist) in zip([A, B], rets, hists):
+                self.assertEqual(hist.shape[1:], arg.shape)
+                self.assertTrue(torch.equal(hist[0], arg))
+                self.assertTrue(torch.equal(hist[-1], ret))
+
+
+class LinesearchTest(unittest.TestCase):
+    def test_batched_fn(self):
+        A = torch.randn((4, 4))
+        A = A @ A.T + torch.eye(4)
+        b = torch.randn((3, 4))
+        # f_fn works for any number of leading batch dimensions
+        f_fn = lambda x: 0.5 * torch.sum(x * (x @ A), -1) - torch.sum(x * b, -1)
+        g_fn = lambda x: x @ A - b
+        h_fn = lambda x: A.expand((x.shape[0], 4, 4))
+        x = torch.randn((3, 4))
+        kw = dict(batched=True, max_it=10, use_tqdm=False)
+        x1 = minimize_sqp(f_fn, g_fn, h_fn, x, **kw)
+        x2 = minimize_sqp(f_fn, g_fn, h_fn, x, batched_fn=True, **kw)
+        self.assertTrue(torch.norm(x1 - x2) < 1e-9)
+        self.assertTrue(torch.norm(g_fn(x1)) < 1e-6)
+
+    def test_data_dependent_f_fn(self):
+        def f_fn(x):
+            if float(torch.sum(x)) > 100.0:
+                return torch.tensor(math.inf)
+            return torch.sum((x - 1.0) ** 2)
+
+        g_fn = lambda x: 2.0 * (x - 1.0)
+        h_fn = lambda x: 2.0 * torch.eye(x.numel())
+        x = minimize_sqp(f_fn, g_fn, h_fn, torch.zeros(3), use_tqdm=False)
+        self.assertTrue(torch.norm(x - 1.0) < 1e-9)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)